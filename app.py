@@ -3,28 +3,36 @@
 import base64
 import gzip
 import io
-import json
+import math
 import os
 import re
 import tempfile
+import time
 import zipfile
-from textwrap import indent
+from array import array
+from email.utils import formatdate
+from hashlib import blake2b
+from http.client import HTTPException
 from pathlib import Path
-from urllib.parse import quote_from_bytes, unquote_to_bytes
-from urllib.request import urlopen
-from multiprocessing import Pool
+from urllib.error import HTTPError
+from urllib.parse import unquote
+from urllib.request import Request, urlopen
+from concurrent.futures import ProcessPoolExecutor
 from itertools import starmap
 
+import orjson
 import streamlit as st
+import zstandard
 from streamlit import session_state as state
 import pandas as pd
 
-from keymap_drawer.draw import KeymapDrawer
 from keymap_drawer.config import DrawConfig
 from keymap_drawer.physical_layout import layout_factory, QmkLayout
-from keymap_drawer.parse.dts import DeviceTree
 
 APP_URL = "https://zmk-physical-layout-converter.streamlit.app/"
+ZMK_ZIP_URL = "https://api.github.com/repos/zmkfirmware/zmk/zipball/main"
+ZMK_ZIP_CACHE = Path(tempfile.gettempdir()) / "zmk-main.zip"
+ZMK_ZIP_MAX_AGE = 24 * 60 * 60  # seconds before revalidating the cached zip with GitHub
 DTS_TEMPLATE = """\
 #include <physical_layouts.dtsi>
 
@@ -33,22 +41,26 @@ DTS_TEMPLATE = """\
 }};
 """
 PL_TEMPLATE = """\
-physical_layout{idx}: physical_layout_{idx} {{
-    compatible = "zmk,physical-layout";
-    display-name = "{name}";
+    physical_layout{idx}: physical_layout_{idx} {{
+        compatible = "zmk,physical-layout";
+        display-name = "{name}";
 
-    kscan = <&kscan{idx}>;
-    transform = <&matrix_transform{idx}>;
+        kscan = <&kscan{idx}>;
+        transform = <&matrix_transform{idx}>;
 {keys}\
-}};
+    }};
 """
 KEYS_TEMPLATE = """
-keys  //                     w   h    x    y     rot    rx    ry
-    = {key_attrs_string}
-    ;
+        keys  //                     w   h    x    y     rot    rx    ry
+            = {key_attrs_string}
+            ;
 """
-KEY_TEMPLATE = "<&key_physical_attrs {w:>3} {h:>3} {x:>4} {y:>4} {rot:>7} {rx:>5} {ry:>5}>"
 PHYSICAL_ATTR_PHANDLES = {"&key_physical_attrs"}
+DTS_COMMENT_RE = re.compile(r'("(?:\\.|[^"\\])*")|//[^\n]*|/\*.*?\*/', re.DOTALL)  # keeps string literals in group 1
+DTS_LEAF_NODE_RE = re.compile(r"([\w,.@-]+)\s*\{([^{}]*)\}\s*;")
+DTS_PROPERTY_RE = re.compile(r"([\w,.#-]+)\s*=\s*([^;]*);")
+KEY_ATTRS_RE = re.compile(r"<\s*&key_physical_attrs((?:\s+(?:\d+|\(-?\d+\))){7})\s*>")
+PERMALINK_ZSTD_TAG = b"\x01"  # legacy permalinks are untagged gzip streams
 
 IS_STREAMLIT_CLOUD = os.getenv("USER") == "appuser"
 
@@ -72,48 +84,164 @@ def handle_exception(container, message: str, exc: Exception):
 
 
 def _normalize_layout(qmk_spec: QmkLayout) -> QmkLayout:
-    min_x, min_y = min(k.x for k in qmk_spec.layout), min(k.y for k in qmk_spec.layout)
+    if not qmk_spec.layout:
+        raise ValueError("Layout does not contain any keys")
+    min_x = min_y = math.inf
+    for key in qmk_spec.layout:  # single pass for both minimums
+        if key.x < min_x:
+            min_x = key.x
+        if key.y < min_y:
+            min_y = key.y
+    # only write the axes that need shifting, attribute assignment on pydantic models is the expensive part
+    if min_x != 0:
+        for key in qmk_spec.layout:
+            key.x -= min_x
+            if key.rx is not None:
+                key.rx -= min_x
+    if min_y != 0:
+        for key in qmk_spec.layout:
+            key.y -= min_y
+            if key.ry is not None:
+                key.ry -= min_y
+    return qmk_spec
+
+
+def _construct_layout(keys: list[dict[str, float]]) -> QmkLayout:
+    """Build a QmkLayout without validation, only for key dicts we generated with the right names and types."""
+    return QmkLayout.model_construct(layout=[QmkLayout.QmkKey.model_construct(None, **key) for key in keys])
+
+
+def _layout_fingerprint(qmk_spec: QmkLayout) -> bytes:
+    """Cheap content key for a layout, used as the cache hash for QmkLayout arguments."""
+    packed = array(
+        "d",
+        [
+            v
+            for k in qmk_spec.layout
+            for v in (k.x, k.y, k.w, k.h, k.r, math.nan if k.rx is None else k.rx, math.nan if k.ry is None else k.ry)
+        ],
+    )
+    return blake2b(packed.tobytes(), digest_size=16).digest()
+
+
+def _dump_layout(qmk_spec: QmkLayout) -> list[dict[str, float]]:
+    """Dump keys of a layout to dicts, omitting default-valued fields like `model_dump(exclude_defaults=True)`."""
+    out = []
     for key in qmk_spec.layout:
-        key.x -= min_x
-        key.y -= min_y
+        key_dict = {"x": key.x, "y": key.y}
+        if key.w != 1.0:
+            key_dict["w"] = key.w
+        if key.h != 1.0:
+            key_dict["h"] = key.h
+        if key.r != 0:
+            key_dict["r"] = key.r
         if key.rx is not None:
-            key.rx -= min_x
+            key_dict["rx"] = key.rx
         if key.ry is not None:
-            key.ry -= min_y
-    return qmk_spec
+            key_dict["ry"] = key.ry
+        out.append(key_dict)
+    return out
 
 
 def get_permalink(keymap_yaml: str) -> str:
     """Encode a keymap using a compressed base64 string and place it in query params to create a permalink."""
-    b64_bytes = base64.b64encode(gzip.compress(keymap_yaml.encode("utf-8"), mtime=0), altchars=b"-_")
-    return f"{APP_URL}?layout={quote_from_bytes(b64_bytes)}"
+    # (de)compressors are created per call, they can't be shared between the threads Streamlit runs sessions in
+    compressed = PERMALINK_ZSTD_TAG + zstandard.ZstdCompressor(level=19).compress(keymap_yaml.encode("utf-8"))
+    b64_str = base64.urlsafe_b64encode(compressed).decode("ascii").rstrip("=")  # nothing left to percent-encode
+    return f"{APP_URL}?layout={b64_str}"
 
 
 def decode_permalink_param(param: str) -> str:
     """Get a compressed base64 string from query params and decode it to keymap YAML."""
-    return gzip.decompress(base64.b64decode(unquote_to_bytes(param), altchars=b"-_")).decode("utf-8")
-
-
-@st.cache_data
-def _get_initial_layout():
-    with open("example.json", encoding="utf-8") as f:
-        return f.read()
-
-
-@st.cache_data(max_entries=10)
+    b64_str = unquote(param).rstrip("=")  # legacy links carry percent-encoded padding
+    compressed = base64.urlsafe_b64decode(b64_str + "=" * (-len(b64_str) % 4))
+    if compressed.startswith(PERMALINK_ZSTD_TAG):
+        return zstandard.ZstdDecompressor().decompress(compressed[len(PERMALINK_ZSTD_TAG) :]).decode("utf-8")
+    return gzip.decompress(compressed).decode("utf-8")
+
+
+@st.cache_resource
+def _get_initial_layout() -> str:
+    return (Path(__file__).parent / "example.json").read_text(encoding="utf-8")
+
+
+def _parse_key_physical_attrs(bindings: list[str]) -> dict[str, int]:
+    """Parse `key_physical_attrs` binding cells, keeping them as integer hundredths of a key unit."""
+    w, h, x, y, r, rx, ry = (int(v.strip("()")) for v in bindings)
+    params = {"w": w, "h": h, "x": x, "y": y, "r": r}
+    if r != 0:
+        params["rx"], params["ry"] = rx, ry
+    return params
+
+
+def _layout_from_hundredths(keys: list[dict[str, int]]) -> QmkLayout:
+    """
+    Normalize parsed DTS keys and convert them to a QmkLayout in key units.
+
+    Shifting is done on the integer hundredths before the single division, so that results like 0.29 - 0.1 come out
+    as 0.19 and not as 0.18999999999999997 like they would with `_normalize_layout` on floats.
+    """
+    if not keys:
+        raise ValueError("Layout does not contain any keys")
+    min_x, min_y = min(k["x"] for k in keys), min(k["y"] for k in keys)
+    for key in keys:
+        key["x"] -= min_x
+        key["y"] -= min_y
+        if "rx" in key:
+            key["rx"] -= min_x
+            key["ry"] -= min_y
+    return _construct_layout([{k: v / 100 for k, v in key.items()} for key in keys])
+
+
+def _scan_physical_layouts(dts_str: str) -> dict[str, list[dict[str, int]]] | None:
+    """
+    Extract physical layout keys from plain DTS text with regexes, without running the preprocessor and parser.
+
+    Only handles the simple case of leaf physical layout nodes with literal `key_physical_attrs` bindings, like this
+    app outputs. Returns None for anything else (macros, node references, missing properties...) so that the caller
+    can fall back to the full DeviceTree parse, which also produces the proper error messages.
+    """
+    if re.search(r"^\s*#(?!include\b)", dts_str, re.MULTILINE):
+        return None
+    stripped = DTS_COMMENT_RE.sub(lambda m: m.group(1) or " ", dts_str)
+    if re.search(r"&[\w-]+\s*\{", stripped):
+        return None
+
+    node_names, layouts = set(), {}
+    for node_name, body in DTS_LEAF_NODE_RE.findall(stripped):
+        if "zmk,physical-layout" not in body:
+            continue
+        props = DTS_PROPERTY_RE.findall(body)
+        prop_map = dict(props)
+        if node_name in node_names or len(prop_map) != len(props):
+            return None
+        node_names.add(node_name)
+        display_name, keys = prop_map.get("display-name", ""), prop_map.get("keys", "")
+        if (
+            prop_map.get("compatible", "").strip() != '"zmk,physical-layout"'
+            or not re.fullmatch(r'\s*"[^"\\]*"\s*', display_name)
+            or not (key_attrs := KEY_ATTRS_RE.findall(keys))
+            or KEY_ATTRS_RE.sub("", keys).replace(",", "").strip()
+        ):
+            return None
+        layouts[display_name.strip()[1:-1]] = [_parse_key_physical_attrs(attrs.split()) for attrs in key_attrs]
+
+    if not layouts or stripped.count("zmk,physical-layout") != len(node_names):
+        return None
+    return layouts
+
+
+@st.cache_data(max_entries=16)
 def dts_to_layouts(dts_str: str) -> dict[str, QmkLayout]:
     """Convert given DTS string containing physical layouts to internal QMK layout format."""
-    dts = DeviceTree(dts_str, None, True)
+    if (scanned := _scan_physical_layouts(dts_str)) is not None:
+        return {name: _layout_from_hundredths(keys) for name, keys in scanned.items()}
 
-    def parse_binding_params(bindings):
-        params = {
-            k: int(v.lstrip("(").rstrip(")")) / 100 for k, v in zip(("w", "h", "x", "y", "r", "rx", "ry"), bindings)
-        }
-        if params["r"] == 0:
-            del params["rx"], params["ry"]
-        return params
+    # imported here since it pulls in the preprocessor and all keymap parsers, and is only needed as a fallback
+    from keymap_drawer.parse.dts import DeviceTree  # pylint: disable=import-outside-toplevel
 
-    bindings_to_position = {"key_physical_attrs": parse_binding_params}
+    dts = DeviceTree(dts_str, None, True)
+    bindings_to_position = {"key_physical_attrs": _parse_key_physical_attrs}
 
     if nodes := dts.get_compatible_nodes("zmk,physical-layout"):
         defined_layouts = {node.get_string("display-name"): node.get_phandle_array("keys") for node in nodes}
@@ -128,15 +256,19 @@ def dts_to_layouts(dts_str: str) -> dict[str, QmkLayout]:
         assert position_bindings is not None, f'No `keys` property found for layout "{display_name}"'
         keys = []
         for binding_arr in position_bindings:
-            binding = binding_arr.split()
-            assert binding[0].lstrip("&") in bindings_to_position, f"Unrecognized position binding {binding[0]}"
-            keys.append(bindings_to_position[binding[0].lstrip("&")](binding[1:]))
-        out_layouts[display_name] = _normalize_layout(QmkLayout(layout=keys))
+            binding_name, *binding_params = binding_arr.split()
+            parse_binding = bindings_to_position.get(binding_name.lstrip("&"))
+            assert parse_binding is not None, f"Unrecognized position binding {binding_name}"
+            keys.append(parse_binding(binding_params))
+        out_layouts[display_name] = _layout_from_hundredths(keys)
     return out_layouts
 
 
+@st.cache_data(max_entries=16, hash_funcs={QmkLayout: _layout_fingerprint})
 def layout_to_svg(qmk_layout: QmkLayout) -> str:
     """Convert given internal QMK layout format to its SVG visualization."""
+    from keymap_drawer.draw import KeymapDrawer  # pylint: disable=import-outside-toplevel
+
     physical_layout = qmk_layout.generate(50)
     with io.StringIO() as out:
         drawer = KeymapDrawer(
@@ -149,58 +281,73 @@ def layout_to_svg(qmk_layout: QmkLayout) -> str:
         return out.getvalue()
 
 
+@st.cache_data(max_entries=32, hash_funcs={QmkLayout: _layout_fingerprint})
 def layouts_to_json(layouts_map: dict[str, QmkLayout]) -> str:
     """Convert given internal QMK layout formats map to JSON representation."""
-    out_layouts = {
-        display_name: {"layout": qmk_layout.model_dump(exclude_defaults=True, exclude_unset=True)["layout"]}
-        for display_name, qmk_layout in layouts_map.items()
-    }
-    return re.sub(r"\n {10}|\n {8}(?=\})", " ", json.dumps({"layouts": out_layouts}, indent=2))
+    # written by hand rather than with an indenting dump so that each key object stays on a single line
+    layout_strs = []
+    for display_name, qmk_layout in layouts_map.items():
+        # key dicts only hold fixed field names and numbers, so the compact dump can be respaced by plain replaces
+        keys_str = orjson.dumps(_dump_layout(qmk_layout)).decode().replace(",", ", ").replace(":", ": ")
+        key_lines = f"        {{ {keys_str[2:-2]} }}".replace("}, {", " },\n        { ") if qmk_layout.layout else ""
+        layout_strs.append(
+            f'    {orjson.dumps(display_name).decode()}: {{\n      "layout": [\n{key_lines}\n      ]\n    }}'
+        )
+    return '{\n  "layouts": {\n' + ",\n".join(layout_strs) + "\n  }\n}"
 
 
+@st.cache_data(max_entries=32, hash_funcs={QmkLayout: _layout_fingerprint})
 def layouts_to_dts(layouts_map: dict[str, QmkLayout]) -> str:
     """Convert given internal QMK layout formats map to DTS representation."""
-
-    def num_to_str(num: float | int) -> str:
-        if num >= 0:
-            return str(round(num))
-        return "(" + str(round(num)) + ")"
-
     pl_nodes = []
     for idx, (name, qmk_spec) in enumerate(layouts_map.items()):
-        keys = KEYS_TEMPLATE.format(
-            key_attrs_string="\n    , ".join(
-                KEY_TEMPLATE.format(
-                    w=num_to_str(100 * key.w),
-                    h=num_to_str(100 * key.h),
-                    x=num_to_str(100 * key.x),
-                    y=num_to_str(100 * key.y),
-                    rot=num_to_str(100 * key.r),
-                    rx=num_to_str(100 * (key.rx or 0)),
-                    ry=num_to_str(100 * (key.ry or 0)),
-                )
-                for key in qmk_spec.layout
+        key_lines = []
+        for key in qmk_spec.layout:
+            cells = (
+                round(100 * key.w),
+                round(100 * key.h),
+                round(100 * key.x),
+                round(100 * key.y),
+                round(100 * key.r),
+                round(100 * key.rx) if key.rx is not None else 0,
+                round(100 * key.ry) if key.ry is not None else 0,
             )
-        )
-        pl_nodes.append(PL_TEMPLATE.format(idx=idx, name=name, keys=indent(keys, "    ")))
-    return DTS_TEMPLATE.format(pl_nodes=indent("\n".join(pl_nodes), "    "))
+            # negative cells need wrapping in parentheses, otherwise the ints can be formatted as they are
+            w, h, x, y, rot, rx, ry = cells if min(cells) >= 0 else tuple(str(n) if n >= 0 else f"({n})" for n in cells)
+            key_lines.append(f"<&key_physical_attrs {w:>3} {h:>3} {x:>4} {y:>4} {rot:>7} {rx:>5} {ry:>5}>")
+        keys = KEYS_TEMPLATE.format(key_attrs_string="\n            , ".join(key_lines))
+        pl_nodes.append(PL_TEMPLATE.format(idx=idx, name=name, keys=keys))
+    return DTS_TEMPLATE.format(pl_nodes="\n".join(pl_nodes))
 
 
 def layout_to_df(layout):
-    """Get a pandas DF from given QmkLayout."""
+    """Get a pandas DF from given QmkLayout, with default-valued fields left empty."""
+    keys = layout.layout
     return pd.DataFrame(
-        layout.model_dump(exclude_defaults=True, exclude_unset=True)["layout"],
-        columns=["x", "y", "w", "h", "r", "rx", "ry"],
+        {
+            "x": [k.x for k in keys],
+            "y": [k.y for k in keys],
+            "w": [k.w if k.w != 1.0 else None for k in keys],
+            "h": [k.h if k.h != 1.0 else None for k in keys],
+            "r": [k.r if k.r != 0 else None for k in keys],
+            "rx": [k.rx for k in keys],
+            "ry": [k.ry for k in keys],
+        },
+        dtype="float64",
     )
 
 
+@st.cache_data(max_entries=16)
 def qmk_json_to_layouts(qmk_info_str: str) -> dict[str, QmkLayout]:
     """Convert given QMK-style JSON string layouts format map to internal QMK layout formats map."""
-    qmk_info = json.loads(qmk_info_str)
+    qmk_info = orjson.loads(qmk_info_str)
 
     if isinstance(qmk_info, list):
-        return {"Default": QmkLayout(layout=qmk_info)}  # shortcut for list-only representation
-    return {name: _normalize_layout(QmkLayout(layout=val["layout"])) for name, val in qmk_info["layouts"].items()}
+        return {"Default": QmkLayout.model_validate({"layout": qmk_info})}  # shortcut for list-only representation
+    return {
+        name: _normalize_layout(QmkLayout.model_validate({"layout": val["layout"]}))
+        for name, val in qmk_info["layouts"].items()
+    }
 
 
 def ortho_to_layouts(
@@ -213,8 +360,8 @@ def ortho_to_layouts(
         cols_thumbs_notation=cols_thumbs_notation,
     )
     return {
-        "Default": QmkLayout(
-            layout=[
+        "Default": _construct_layout(
+            [
                 {"x": key.pos.x - key.width / 2, "y": key.pos.y - key.height / 2, "w": key.width, "h": key.height}
                 for key in p_layout.keys
             ]
@@ -222,33 +369,57 @@ def ortho_to_layouts(
     }
 
 
-def _read_layout(common_path: Path, path: Path) -> tuple[str, None | dict[str, QmkLayout]]:
-    name = str(path.relative_to(common_path))
+def _read_layout(name: str, dts_str: str) -> tuple[str, None | dict[str, QmkLayout]]:
     try:
-        with open(path, encoding="utf-8") as f:
-            return name, dts_to_layouts(f.read())
+        return name, dts_to_layouts(dts_str)
     except ValueError:
         return name, None
 
 
-@st.cache_data
+def _fetch_zmk_zip() -> bytes:
+    """Get the zipball of ZMK main branch, reusing the on-disk copy while it is fresh or unmodified upstream."""
+    request = Request(ZMK_ZIP_URL)
+    if has_cache := ZMK_ZIP_CACHE.exists():
+        mtime = ZMK_ZIP_CACHE.stat().st_mtime
+        if time.time() - mtime < ZMK_ZIP_MAX_AGE:
+            return ZMK_ZIP_CACHE.read_bytes()
+        request.add_header("If-Modified-Since", formatdate(mtime, usegmt=True))
+    try:
+        with urlopen(request) as f:
+            zip_bytes = f.read()
+    except (OSError, HTTPException) as exc:  # OSError covers URLError and HTTPError
+        if isinstance(exc, HTTPError) and exc.code == 304:
+            ZMK_ZIP_CACHE.touch()
+            return ZMK_ZIP_CACHE.read_bytes()
+        if not has_cache:
+            raise
+        # a stale copy beats failing, e.g. when GitHub rate limits unauthenticated requests with a 403
+        return ZMK_ZIP_CACHE.read_bytes()
+    partial = ZMK_ZIP_CACHE.with_suffix(".part")
+    partial.write_bytes(zip_bytes)
+    partial.replace(ZMK_ZIP_CACHE)
+    return zip_bytes
+
+
+@st.cache_resource
 def get_shared_layouts() -> dict[str, dict[str, QmkLayout]]:
     """Get shared layouts from ZMK repo so they can be used as a starting point."""
-    with urlopen("https://api.github.com/repos/zmkfirmware/zmk/zipball/main") as f:
-        zip_bytes = f.read()
-    with tempfile.TemporaryDirectory() as tmpdir:
-        with zipfile.ZipFile(io.BytesIO(zip_bytes)) as zipped:
-            zipped.extractall(tmpdir)
-        common_layouts = next(Path(tmpdir).iterdir()) / "app" / "dts" / "layouts"
-
-        if IS_STREAMLIT_CLOUD:
-            out = dict(starmap(_read_layout, ((common_layouts, path) for path in common_layouts.rglob("*.dtsi"))))
-        else:
-            with Pool() as mp:
-                out = dict(
-                    mp.starmap(_read_layout, ((common_layouts, path) for path in common_layouts.rglob("*.dtsi")))
-                )
-        return {k: v for k in sorted(out) if (v := out[k]) is not None}
+    zip_bytes = _fetch_zmk_zip()
+    layouts_prefix = "app/dts/layouts/"
+    with zipfile.ZipFile(io.BytesIO(zip_bytes)) as zipped:
+        dtsi_files = {}
+        for member in zipped.namelist():
+            path = member.partition("/")[2]  # strip the "<owner>-<repo>-<sha>/" top-level folder
+            if path.startswith(layouts_prefix) and path.endswith(".dtsi"):
+                dtsi_files[path.removeprefix(layouts_prefix)] = zipped.read(member).decode("utf-8")
+
+    if IS_STREAMLIT_CLOUD:
+        out = dict(starmap(_read_layout, dtsi_files.items()))
+    else:
+        # few workers with batched files: most files take the ~0.5ms regex scan, so process startup and IPC dominate
+        with ProcessPoolExecutor(max_workers=4) as executor:
+            out = dict(executor.map(_read_layout, dtsi_files, dtsi_files.values(), chunksize=8))
+    return {k: v for k in sorted(out) if (v := out[k]) is not None}
 
 
 def _ortho_form() -> dict[str, QmkLayout] | None:
@@ -303,10 +474,17 @@ def _ortho_form() -> dict[str, QmkLayout] | None:
     return out
 
 
+def _set_layouts(layouts_map: dict[str, QmkLayout]) -> None:
+    """Replace the current layouts, keeping their names in sync and flagging the text areas for an update."""
+    state.layouts = layouts_map
+    state.layout_names = tuple(layouts_map)
+    state.need_update = True
+
+
 @st.dialog("Edit layout")
 def df_editor():
     """Show the dialog box that has the dataframe editor."""
-    selected = st.selectbox("Layout to edit", list(state.layouts))
+    selected = st.selectbox("Layout to edit", state.layout_names)
     df = st.data_editor(
         layout_to_df(state.layouts[selected]),
         column_config=COL_CFG,
@@ -315,13 +493,27 @@ def df_editor():
         use_container_width=True,
     )
     if st.button("Update"):
-        state.layouts[selected] = QmkLayout(
-            layout=[{k: v for k, v in record.items() if not pd.isna(v)} for record in df.to_dict("records")]
+        state.layouts[selected] = QmkLayout.model_validate(
+            {
+                "layout": [
+                    {k: v for k, v in zip(df.columns, row) if not pd.isna(v)}
+                    for row in df.itertuples(index=False, name=None)
+                ]
+            }
         )
         state.need_update = True
         st.rerun()
 
 
+def _update_from_json() -> None:
+    """Button callback to parse the JSON field, run before the script so other columns see the result."""
+    print("1.0 updating rest from json")
+    try:
+        _set_layouts(qmk_json_to_layouts(state.json_field))
+    except Exception as exc:
+        state.json_error = exc
+
+
 def json_column() -> None:
     """Contents of the json column."""
     st.subheader("JSON description", anchor=False)
@@ -334,15 +526,26 @@ def json_column() -> None:
         state.json_field = layouts_to_json(state.layouts)
 
     st.text_area("JSON layout", key="json_field", height=800, label_visibility="collapsed")
-    json_button = st.button("Update DTS using this ➡️")
-    if json_button:
-        print("1.0 updating rest from json")
-        try:
-            state.layouts = qmk_json_to_layouts(state.json_field)
-        except Exception as exc:
-            handle_exception(st, "Failed to parse JSON", exc)
-        else:
-            state.need_update = True
+    st.button("Update DTS using this ➡️", on_click=_update_from_json)
+    if (exc := state.pop("json_error", None)) is not None:
+        handle_exception(st, "Failed to parse JSON", exc)
+
+
+def _parse_dts_field(dts_str: str) -> dict[str, QmkLayout]:
+    """Parse DTS text area contents, reusing the last result if the text did not change since."""
+    if state.get("last_dts_input") != dts_str:
+        state.last_dts_layouts = dts_to_layouts(dts_str)
+        state.last_dts_input = dts_str
+    return dict(state.last_dts_layouts)  # copy since layouts get replaced in place by the editor
+
+
+def _update_from_dts() -> None:
+    """Button callback to parse the DTS field, run before the script so other columns see the result."""
+    print("2.1 updating rest from dts")
+    try:
+        _set_layouts(_parse_dts_field(state.dts_field))
+    except Exception as exc:
+        state.dts_error = exc
 
 
 def dts_column() -> None:
@@ -359,23 +562,22 @@ def dts_column() -> None:
     if state.need_update:
         state.dts_field = layouts_to_dts(state.layouts)
     st.text_area("Devicetree", key="dts_field", height=800, label_visibility="collapsed")
-    dts_button = st.button("⬅️Update JSON using this")
-    if dts_button:
-        print("2.1 updating rest from dts")
-        try:
-            state.layouts = dts_to_layouts(state.dts_field)
-        except Exception as exc:
-            handle_exception(st, "Failed to parse DTS", exc)
-        else:
-            state.need_update = True
+    st.button("⬅️Update JSON using this", on_click=_update_from_dts)
+    if (exc := state.pop("dts_error", None)) is not None:
+        handle_exception(st, "Failed to parse DTS", exc)
 
 
+@st.fragment
 def svg_column() -> None:
     """Contents of the SVG column."""
     st.subheader("Visualization", anchor=False)
-    svgs = {name: layout_to_svg(layout) for name, layout in state.layouts.items()}
-    shown = st.selectbox(label="Select", label_visibility="collapsed", options=list(svgs))
-    st.image(svgs[shown])
+    shown = st.selectbox(label="Select", label_visibility="collapsed", options=state.layout_names)
+    layout = state.layouts[shown]
+    # layouts get replaced rather than mutated, so an identical object means the last rendered SVG is still valid
+    if state.get("svg_layout") is not layout:
+        state.svg = layout_to_svg(layout)
+        state.svg_layout = layout
+    st.image(state.svg)
 
 
 def main() -> None:
@@ -388,26 +590,20 @@ def main() -> None:
     if "need_update" not in state:
         state.need_update = False
 
-    updated = state.need_update
-
     if layout_json := st.query_params.get("layout"):
-        state.layouts = qmk_json_to_layouts(decode_permalink_param(layout_json))
-        state.need_update = True
+        _set_layouts(qmk_json_to_layouts(decode_permalink_param(layout_json)))
         print("0.0 read json from query params")
         st.query_params.clear()
-        st.rerun()
 
     if "layouts" not in state:
-        state.layouts = qmk_json_to_layouts(_get_initial_layout())
-        state.need_update = True
+        _set_layouts(qmk_json_to_layouts(_get_initial_layout()))
 
     gen_cols = st.columns([0.2, 0.25, 0.2, 0.35])
     with gen_cols[0]:
         with st.popover("Initialize from ortho params", use_container_width=True):
             ortho_layout = _ortho_form()
             if ortho_layout is not None:
-                state.layouts = ortho_layout
-                state.need_update = True
+                _set_layouts(ortho_layout)
                 ortho_layout = None
 
     with gen_cols[1]:
@@ -422,8 +618,7 @@ def main() -> None:
             with st.form("shared_layouts"):
                 selected = st.selectbox("Shared layouts", list(shared_layouts))
                 if st.form_submit_button("Use this") and selected is not None:
-                    state.layouts = shared_layouts[selected]
-                    state.need_update = True
+                    _set_layouts(dict(shared_layouts[selected]))  # shared across sessions, don't edit in place
 
     with gen_cols[2]:
         if st.button("Edit with dataframe editor", use_container_width=True):
@@ -447,12 +642,8 @@ def main() -> None:
     if permabutton:
         st.code(get_permalink(state.json_field), language=None, wrap_lines=True)
 
-
-    if updated:
-        state.need_update = False
-
-    if state.need_update:
-        st.rerun()
+    # all layout changes happen before the text areas are drawn, so they are in sync by now
+    state.need_update = False
 
 
 if __name__ == "__main__":